@@ -1,103 +1,264 @@
 """
 Removes old versions of Lambda functions.
 """
-from __future__ import print_function
 import argparse
-import boto3
-try:
-    import queue
-except ImportError:
-    import Queue as queue
+import logging
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from boto3.session import Session
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
 
 LATEST = '$LATEST'
 
+# Shared by every regional client: the pool has to serve the function and
+# delete worker threads, adaptive retries absorb rate limits, and TCP
+# keepalive saves re-establishing TLS between pagination calls
+_SHARED_CONFIG = Config(
+    max_pool_connections=64,
+    tcp_keepalive=True,
+    connect_timeout=5,
+    read_timeout=30,
+    retries={'mode': 'adaptive', 'max_attempts': 10}
+)
+
+logger = logging.getLogger(__name__)
+
+
+_lambda_regions = None
+
 
 def list_available_lambda_regions():
     """
-    Enumerates list of all Lambda regions
+    Enumerates list of all Lambda regions, cached at module scope so warm
+    Lambda invocations don't rebuild a Session and re-parse endpoint data
     :return: list of regions
     """
-    session = Session()
-    return session.get_available_regions('lambda')
+    global _lambda_regions
+    if _lambda_regions is None:
+        _lambda_regions = Session().get_available_regions('lambda')
+    return _lambda_regions
 
 
-def init_boto_client(client_name, region, args):
+def init_boto_session(args):
     """
-    Initiates boto's client object
-    :param client_name: client name
-    :param region: region name
+    Initiates boto's session object, built once and shared by all regional
+    clients to avoid re-parsing configuration and credentials per region
     :param args: arguments
-    :return: Client
+    :return: Session
     """
     if args.token_key_id and args.token_secret:
-        boto_client = boto3.client(
-            client_name,
+        return Session(
             aws_access_key_id=args.token_key_id,
-            aws_secret_access_key=args.token_secret,
-            region_name=region
+            aws_secret_access_key=args.token_secret
         )
-    elif args.profile:
-        session = boto3.session.Session(profile_name=args.profile)
-        boto_client = session.client(client_name, region_name=region)
-    else:
-        boto_client = boto3.client(client_name, region_name=region)
+    if args.profile:
+        return Session(profile_name=args.profile)
+    return Session()
 
-    return boto_client
+
+def init_boto_client(session, client_name, region):
+    """
+    Initiates boto's client object
+    :param session: shared Session
+    :param client_name: client name
+    :param region: region name
+    :return: Client
+    """
+    return session.client(client_name, region_name=region, config=_SHARED_CONFIG)
 
 
-def lambda_function_generator(lambda_client):
+def lambda_versions_generator(lambda_client):
     """
-    Iterates over Lambda functions in a specific region
+    Iterates over every version of every Lambda function in a specific region,
+    using a single paginated listing instead of one call per function
     :param lambda_client: Client
     :return: Generator
     """
-    next_marker = None
-    try:
-        response = lambda_client.list_functions()
-    except Exception:
-        print('Could not scan region')
-        return iter([])
+    paginator = lambda_client.get_paginator('list_functions')
+    for page in paginator.paginate(
+        FunctionVersion='ALL',
+        PaginationConfig={'PageSize': 10000}
+    ):
+        for version in page['Functions']:
+            yield version
 
-    while next_marker != '':
-        next_marker = ''
-        functions = response['Functions']
-        for lambda_function in functions:
-            yield lambda_function
 
-        # Verify if there is next marker
-        if 'NextMarker' in response:
-            next_marker = response['NextMarker']
-            response = lambda_client.list_functions(Marker=next_marker)
+def named_function_versions_generator(lambda_client, function_names):
+    """
+    Iterates over every version of explicitly requested functions, skipping
+    names that don't exist in the region
+    :param lambda_client: Client
+    :param function_names: list of function names
+    :return: Generator
+    """
+    paginator = lambda_client.get_paginator('list_versions_by_function')
+    for function_name in function_names:
+        try:
+            for page in paginator.paginate(
+                FunctionName=function_name,
+                PaginationConfig={'PageSize': 10000}
+            ):
+                for version in page['Versions']:
+                    yield version
+        except ClientError:
+            continue
 
 
-def lambda_version_generator(lambda_client, lambda_function):
+class RateLimiter:
+    """
+    Limits calls to a maximum rate per second across threads, so the delete
+    fan-out doesn't outrun the account's Lambda API quota
+    """
+
+    def __init__(self, max_per_second):
+        self._max_per_second = max_per_second
+        self._timestamps = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a call is allowed under the configured rate
+        :return: None
+        """
+        if not self._max_per_second:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._timestamps and now - self._timestamps[0] >= 1.0:
+                    self._timestamps.popleft()
+                if len(self._timestamps) < self._max_per_second:
+                    self._timestamps.append(now)
+                    return
+                wait_time = 1.0 - (now - self._timestamps[0])
+            time.sleep(wait_time)
+
+
+def _delete_version(lambda_client, version_to_delete, args, counters, lock, rate_limiter):
     """
-    Iterates over Lambda function versions for a specific function
+    Deletes a single old version of a Lambda function
     :param lambda_client: Client
-    :param lambda_function: Lambda dict
-    :return: Generator
+    :param version_to_delete: version dict
+    :param args: arguments
+    :param counters: shared counters dict of the region
+    :param lock: lock guarding the shared counters
+    :param rate_limiter: limiter shared by the region's delete calls
+    :return: None
     """
-    next_marker = None
-    response = lambda_client.list_versions_by_function(
-        FunctionName=lambda_function['FunctionArn']
-    )
+    logger.info(f"Detected {version_to_delete['FunctionName']} with an old version {version_to_delete['Version']}")
+    with lock:
+        counters['deleted_functions'][version_to_delete['FunctionName']] += 1
+        counters['deleted_code_bytes'] += version_to_delete['CodeSize']
+
+    # DELETE OPERATION!
+    if args.dry_run:
+        logger.info(f"Dry-Run: This process would delete function: {version_to_delete['FunctionArn']}")
+    else:
+        try:
+            rate_limiter.acquire()
+            lambda_client.delete_function(
+                FunctionName=version_to_delete['FunctionArn']
+            )
+        except ClientError as exception:
+            logger.warning(f'Could not delete function: {str(exception)}')
 
-    while next_marker != '':
-        next_marker = ''
-        versions = response['Versions']
-        for version in versions:
-            yield version
 
-        # Verify if there is next marker
-        if 'NextMarker' in response:
-            next_marker = response['NextMarker']
-            response = lambda_client.list_versions_by_function(
-                FunctionName=lambda_function['FunctionArn'],
-                Marker=next_marker
+def _process_function(lambda_client, versions, args, counters, lock, delete_executor, rate_limiter):
+    """
+    Removes old versions of a single Lambda function
+    :param lambda_client: Client
+    :param versions: all published versions of the function
+    :param args: arguments
+    :param counters: shared counters dict of the region
+    :param lock: lock guarding the shared counters
+    :param delete_executor: executor running the delete calls
+    :param rate_limiter: limiter shared by the region's delete calls
+    :return: None
+    """
+    # Keeping the N most recent versions means deleting everything before
+    # the cutoff
+    versions.sort(key=lambda version: int(version['Version']))
+    if len(versions) <= args.num_to_keep:
+        return
+
+    # Fan the delete calls out so a function with many old versions doesn't
+    # serialize its round-trips
+    delete_futures = [
+        delete_executor.submit(
+            _delete_version, lambda_client, version_to_delete, args, counters, lock, rate_limiter
+        )
+        for version_to_delete in versions[:len(versions) - args.num_to_keep]
+    ]
+    for future in as_completed(delete_futures):
+        future.result()
+
+
+def _scan_region(session, region, args):
+    """
+    Scans a single region and removes old versions of its Lambda functions
+    :param session: shared Session
+    :param region: region name
+    :param args: arguments
+    :return: Tuple of deleted versions count per function and deleted code size
+    """
+    counters = {'deleted_functions': Counter(), 'deleted_code_bytes': 0}
+    lock = threading.Lock()
+    rate_limiter = RateLimiter(args.delete_tps)
+    logger.info(f'Scanning {region} region')
+
+    lambda_client = init_boto_client(session, 'lambda', region)
+
+    # A single cheap account-settings call tells whether the region has any
+    # functions at all, sparing the listing round-trips in unused regions.
+    # The probe is best-effort: policies without lambda:GetAccountSettings
+    # fall through to the normal listing
+    try:
+        function_count = lambda_client.get_account_settings()['AccountUsage']['FunctionCount']
+    except ClientError:
+        function_count = None
+    if function_count == 0:
+        logger.info(f'No functions in {region} region, skipping')
+        return counters['deleted_functions'], counters['deleted_code_bytes']
+
+    # When specific functions are requested, query just those by name
+    # instead of listing (and discarding) every function in the region.
+    # Otherwise a single FunctionVersion='ALL' listing returns every
+    # version of every function in one paginated call
+    if args.function_names:
+        version_generator = named_function_versions_generator(lambda_client, args.function_names)
+    else:
+        version_generator = lambda_versions_generator(lambda_client)
+
+    function_versions = defaultdict(list)
+    for version in version_generator:
+        if version['Version'] == LATEST:
+            continue
+        function_versions[version['FunctionName']].append(version)
+
+    # Functions are processed concurrently so the deletions of one function
+    # overlap the round-trips of the others. Deletions run on a separate
+    # pool so a function worker never waits on its own pool
+    with ThreadPoolExecutor(max_workers=args.function_concurrency or 16) as executor, \
+            ThreadPoolExecutor(max_workers=32) as delete_executor:
+        futures = [
+            executor.submit(
+                _process_function, lambda_client, versions, args, counters, lock,
+                delete_executor, rate_limiter
             )
+            for versions in function_versions.values()
+        ]
+
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as exception:
+                logger.warning(f'Could not process function: {str(exception)}')
+
+    return counters['deleted_functions'], counters['deleted_code_bytes']
 
 
 def remove_old_lambda_versions(args):
@@ -107,63 +268,36 @@ def remove_old_lambda_versions(args):
     :return: None
     """
     regions = args.regions or list_available_lambda_regions()
-    total_deleted_code_size = 0
-    total_deleted_functions = {}
-    num_to_keep = args.num_to_keep
-    print('Keeping {} versions for functions'.format(num_to_keep))
+    session = init_boto_session(args)
+    total_deleted_code_bytes = 0
+    total_deleted_functions = Counter()
+    logger.info(f'Keeping {args.num_to_keep} versions for functions')
     if args.function_names:
-        print('Will only delete lambda versions for functions: {}'.format(" ,".join(args.function_names)))
-
-    for region in regions:
-        print('Scanning {} region'.format(region))
-
-        lambda_client = init_boto_client('lambda', region, args)
-        try:
-            function_generator = lambda_function_generator(lambda_client)
-        except Exception as exception:
-            print('Could not scan region: {}'.format(str(exception)))
-            continue
-
-        for lambda_function in function_generator:
-            # Verify if function name is provided and in case it is, skips all lambdas which name does not match
-            if args.function_names and lambda_function['FunctionName'] not in args.function_names:
+        logger.info(f"Will only delete lambda versions for functions: {' ,'.join(args.function_names)}")
+
+    # Scanning is dominated by network round-trips, so regions are scanned concurrently
+    region_concurrency = args.region_concurrency or min(16, len(regions))
+    with ThreadPoolExecutor(max_workers=region_concurrency) as executor:
+        futures = {
+            executor.submit(_scan_region, session, region, args): region
+            for region in regions
+        }
+        for future in as_completed(futures):
+            try:
+                deleted_functions, deleted_code_bytes = future.result()
+            except Exception as exception:
+                logger.warning(f'Could not scan region {futures[future]}: {str(exception)}')
                 continue
 
-            versions_to_keep = queue.Queue(maxsize=num_to_keep)
-
-            for version in lambda_version_generator(lambda_client, lambda_function):
-
-                if version['Version'] in (lambda_function['Version'], '$LATEST'):
-                    continue
-
-                if versions_to_keep.full():
-                    version_to_delete = versions_to_keep.get()
-                    print('Detected {} with an old version {}'.format(
-                        version_to_delete['FunctionName'],
-                        version_to_delete['Version'])
-                    )
-                    total_deleted_functions.setdefault(version_to_delete['FunctionName'], 0)
-                    total_deleted_functions[version_to_delete['FunctionName']] += 1
-                    total_deleted_code_size += (version_to_delete['CodeSize'] / (1024 * 1024))
-
-                    # DELETE OPERATION!
-                    if args.dry_run:
-                        print('Dry-Run: This process would delete function: {}'.format(version_to_delete["FunctionArn"]))
-                    else:
-                        try:
-                            lambda_client.delete_function(
-                                FunctionName=version_to_delete['FunctionArn']
-                            )
-                        except ClientError as exception:
-                            print('Could not delete function: {}'.format(str(exception)))
-                versions_to_keep.put(version)
-
-    print('-' * 10)
-    print('Deleted {} versions from {} functions'.format(
-        sum(total_deleted_functions.values()),
-        len(total_deleted_functions.keys())
-    ))
-    print('Freed {} MBs'.format(int(total_deleted_code_size)))
+            total_deleted_functions += deleted_functions
+            total_deleted_code_bytes += deleted_code_bytes
+
+    logger.info('-' * 10)
+    logger.info(
+        f'Deleted {sum(total_deleted_functions.values())} versions '
+        f'from {len(total_deleted_functions)} functions'
+    )
+    logger.info(f'Freed {total_deleted_code_bytes >> 20} MBs')
 
 
 def main():
@@ -227,6 +361,38 @@ def main():
         metavar='function-names'
     )
 
+    parser.add_argument(
+        '--region-concurrency',
+        type=int,
+        help=(
+            'Number of regions to scan concurrently. Optional '
+            '(default: min(number of regions, 16)).'
+        ),
+        metavar='region-concurrency'
+    )
+
+    parser.add_argument(
+        '--delete-tps',
+        type=int,
+        default=10,
+        help=(
+            'Maximum delete calls per second in each region, 0 to disable '
+            'rate limiting. Optional (default: 10).'
+        ),
+        metavar='delete-tps'
+    )
+
+    parser.add_argument(
+        '--function-concurrency',
+        type=int,
+        default=16,
+        help=(
+            'Number of functions to process concurrently in each region. Optional '
+            '(default: 16).'
+        ),
+        metavar='function-concurrency'
+    )
+
     parser.add_argument(
         '--dry-run',
         type=bool,
@@ -241,4 +407,5 @@ def main():
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
     main()
@@ -1,7 +1,34 @@
+import json
+import logging
 from argparse import Namespace
-from clear_lambda_storage import remove_old_lambda_versions
+
+import boto3
+
+from clear_lambda_storage import list_available_lambda_regions, remove_old_lambda_versions
 
 
 def clear_lambda_storage(event, context):
-    remove_old_lambda_versions(Namespace(token_key_id=None, token_secret=None, regions=None, profile=None, num_to_keep=2, function_names=None, dry_run=None))
+    # The Lambda runtime attaches a handler to the root logger but leaves
+    # the level at WARNING, which would swallow all progress output
+    logging.getLogger('clear_lambda_storage').setLevel(logging.INFO)
+
+    # Only self-invocations carry 'target_region'; scheduled EventBridge
+    # events have a top-level 'region' of their own, so that key can't be
+    # used to tell the dispatcher and worker branches apart
+    region = (event or {}).get('target_region')
+
+    if region is None:
+        # Dispatcher invocation: fan out one async invocation of this function
+        # per region, so each region gets its own 15-minute time budget
+        lambda_client = boto3.client('lambda')
+        regions = list_available_lambda_regions()
+        for target_region in regions:
+            lambda_client.invoke(
+                FunctionName=context.function_name,
+                InvocationType='Event',
+                Payload=json.dumps({'target_region': target_region})
+            )
+        return "Dispatched cleaning of {} regions! 🗑".format(len(regions))
+
+    remove_old_lambda_versions(Namespace(token_key_id=None, token_secret=None, regions=[region], profile=None, num_to_keep=2, function_names=None, region_concurrency=None, delete_tps=10, function_concurrency=16, dry_run=None))
     return "Successful clean! 🗑 ✅"